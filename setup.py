@@ -21,7 +21,7 @@ setuptools.setup(
         "Topic :: Database :: Front-Ends",
         "Topic :: Education :: Testing",
     ],
-    python_requires='>=3.8',
+    python_requires='>=3.10',
     entry_points={
         'console_scripts': [
             'sql_quiz=sql_quiz.main:main',
@@ -2,21 +2,28 @@
 
 from __future__ import annotations
 
+import json
 import os
 import sys
-from dataclasses import dataclass
-from typing import List, Callable
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Callable, Optional
 
+import click
 import yaml
 import pgcli.main
-from pgspecial.main import RAW_QUERY
+from pgspecial.main import NO_QUERY, RAW_QUERY
 from prompt_toolkit.shortcuts import message_dialog
 from pygments import highlight
 from pygments.formatters import get_formatter_by_name
 from pygments.lexers import get_lexer_by_name
 
-postgres_lexer = get_lexer_by_name('postgres')
-terminal256_formatter = get_formatter_by_name('terminal256')
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    # PyYAML built without libyaml: fall back to the (much slower) pure-Python versions
+    from yaml import SafeLoader, SafeDumper
 
 quiz_filepath = ""
 
@@ -30,8 +37,28 @@ This should return:
 {output}
 """
 
+# Our special commands: (command, QuizCli method name, description, arg type)
+_COMMANDS = (
+    ("\\question", "quiz_show_prompt", "Show quiz question", NO_QUERY),
+    ("\\next", "quiz_next_question", "Move to next question", NO_QUERY),
+    ("\\solution", "quiz_show_solution", "Show solution to problem", NO_QUERY),
+    ("\\export_closed_quiz", "quiz_export_closed_quiz", "Export solution-free quiz", RAW_QUERY),
+)
 
-@dataclass
+
+@lru_cache(maxsize=1)
+def _lexer():
+    """Postgres lexer; built on first use, since Pygments lookup is slow."""
+    return get_lexer_by_name('postgres')
+
+
+@lru_cache(maxsize=1)
+def _formatter():
+    """Terminal formatter; built on first use, since Pygments lookup is slow."""
+    return get_formatter_by_name('terminal256')
+
+
+@dataclass(slots=True)
 class Quiz:
     """A quiz: questions for users to solve."""
 
@@ -41,18 +68,52 @@ class Quiz:
     questions: list
     filepath: str
 
-    _expected_attached: bool = False
     current_num: int = 0
-
-    @property
-    def question(self) -> dict:
-        return self.questions[self.current_num]
+    _current_question: Optional[dict] = None
+    _ansi_solution_cache: dict = field(default_factory=dict)
 
     @classmethod
     def load_from_yaml_file(cls, filepath: str) -> Quiz:
-        """Get quiz from YAML file and return new instance."""
+        """Get quiz from YAML file and return new instance.
+
+        Parsing YAML is slow, so we keep a JSON copy next to the file, along with
+        the mtime and size of the YAML it came from, and use that while they match.
+        """
+
+        json_filepath = filepath + ".json"
+        stat = os.stat(filepath)
+        source = dict(mtime=stat.st_mtime_ns, size=stat.st_size)
+
+        try:
+            with open(json_filepath) as f:
+                cached = json.load(f)
+            quiz_data = cached['quiz'] if cached['source'] == source else None
+        except (ValueError, OSError, KeyError, TypeError):
+            # Missing, unreadable, or not what we wrote: just parse the YAML
+            quiz_data = None
+
+        if quiz_data is None:
+            # Reading it all up front and parsing from memory is quicker than having
+            # the parser pull from the file a chunk at a time
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            quiz_data = yaml.load(data, Loader=SafeLoader)
+
+            # Write to a temp file and move it into place, so an interrupted write
+            # can't leave a half-written cache behind
+            tmp_filepath = f"{json_filepath}.{os.getpid()}.tmp"
+            try:
+                cached = json.dumps(dict(source=source, quiz=quiz_data))
+                with open(tmp_filepath, "w") as f:
+                    f.write(cached)
+                os.replace(tmp_filepath, json_filepath)
+            except (TypeError, OSError):
+                # Not being able to write the cache just means the next load is slow
+                try:
+                    os.remove(tmp_filepath)
+                except OSError:
+                    pass
 
-        quiz_data = yaml.load(open(filepath), Loader=yaml.SafeLoader)
         quiz_data['filepath'] = filepath
         return cls(**quiz_data)
 
@@ -67,12 +128,18 @@ class Quiz:
                 output, query = eval_fn(q['solution'])
                 q['expected'] = output
 
-        self._expected_attached = True
+        # Prompts only depend on fields that are fixed from here on, so build them once
+        for q in self.questions:
+            q['_full_prompt'] = FULL_PROMPT.format(
+                title=q['title'],
+                prompt=q['prompt'],
+                output="\n".join("    " + line for line in q.get('expected', ())))
 
     def start(self) -> dict:
         """Start quiz: set first question, return title/description to display."""
 
         self.current_num = 0
+        self._current_question = self.questions[0]
 
         return dict(
             title=self.title,
@@ -82,22 +149,24 @@ class Quiz:
     def verify_answer(self, output: List[str]) -> bool:
         """Compare student output to expected."""
 
-        return output == self.question['expected']
+        # A question with nothing to check against can't be answered correctly
+        expected = self._current_question.get('expected')
+        if expected is None:
+            return False
+
+        return output == expected
 
     def full_prompt(self) -> str:
         """Return full prompt for this question, to display."""
 
-        output = "    " + "\n    ".join(self.question['expected'])
-        return FULL_PROMPT.format(
-            title=self.question['title'],
-            prompt=self.question['prompt'],
-            output=output)
+        return self._current_question['_full_prompt']
 
     def goto_next(self) -> str:
         """Go to next question."""
 
         if self.current_num < len(self.questions) - 1:
             self.current_num += 1
+            self._current_question = self.questions[self.current_num]
             return self.full_prompt()
 
         else:
@@ -106,27 +175,43 @@ class Quiz:
     def solution(self) -> str:
         """Show complete answer."""
 
-        return self.question['solution']
+        return self._current_question['solution']
 
-    def export_closed_quiz(self, filename: str) -> None:
-        """Export YAML of quiz w/expected but no solutions."""
+    def highlighted_solution(self) -> str:
+        """Show complete answer, syntax-highlighted (cached per question)."""
 
-        self.closed = True
-        del self.filepath
+        num = self.current_num
+        ansi = self._ansi_solution_cache.get(num)
+        if ansi is None:
+            ansi = highlight(self.solution(), _lexer(), _formatter())
+            self._ansi_solution_cache[num] = ansi
+        return ansi
 
-        for q in self.questions:
-            if 'solution' in q:
-                del q['solution']
+    def prewarm_highlights(self) -> None:
+        """Highlight every solution ahead of time, so showing one is instant."""
 
+        lexer, formatter = _lexer(), _formatter()
+
+        for num, q in enumerate(self.questions):
+            if num not in self._ansi_solution_cache and 'solution' in q:
+                self._ansi_solution_cache[num] = highlight(q['solution'], lexer, formatter)
+
+    def export_closed_quiz(self, filename: str) -> None:
+        """Export YAML of quiz w/expected but no solutions."""
+
+        # Build a copy, rather than stripping the live quiz, so the running quiz
+        # keeps its solutions (and is left alone if the export fails)
         quiz = dict(
             title=self.title,
             description=self.description,
-            questions=self.questions,
-            closed=self.closed,
+            # Drop solutions, and our precomputed, private keys
+            questions=[{k: v for k, v in q.items() if k != 'solution' and not k.startswith('_')}
+                       for q in self.questions],
+            closed=True,
         )
 
         with open(filename, "w") as f:
-            yaml.dump(quiz, f)
+            yaml.dump(quiz, f, Dumper=SafeDumper, default_flow_style=False)
 
 
 class QuizCli(pgcli.main.PGCli):
@@ -138,57 +223,59 @@ class QuizCli(pgcli.main.PGCli):
         # noinspection PyAttributeOutsideInit
         self.quiz = Quiz.load_from_yaml_file(quiz_filepath)
 
-        self.pgspecial.register(
-            self.quiz_show_prompt,
-            "\\question",
-            "\\question",
-            "Show quiz question",
-            arg_type=pgcli.main.NO_QUERY)
+        # Success log; opened on the first correct answer, then kept open
+        # noinspection PyAttributeOutsideInit
+        self._log_fh = None
 
-        self.pgspecial.register(
-            self.quiz_next_question,
-            "\\next",
-            "\\next",
-            "Move to next question",
-            arg_type=pgcli.main.NO_QUERY)
+        # Question we last showed the success dialog for
+        # noinspection PyAttributeOutsideInit
+        self._last_verified_num = None
 
-        if not self.quiz.closed:
+        for name, method, description, arg_type in _COMMANDS:
+            if name == "\\solution" and self.quiz.closed:
+                # Closed quizzes don't have solutions to show
+                continue
             self.pgspecial.register(
-                self.quiz_show_solution,
-                "\\solution",
-                "\\solution",
-                "Show solution to problem",
-                arg_type=pgcli.main.NO_QUERY)
-
-        self.pgspecial.register(
-            self.quiz_export_closed_quiz,
-            "\\export_closed_quiz",
-            "\\export_closed_quiz",
-            "Export solution-free quiz",
-            arg_type=RAW_QUERY
-        )
+                getattr(self, method), name, name, description, arg_type=arg_type)
 
         welcome = self.quiz.start()
 
         message_dialog(title=welcome['title'], text=welcome['description']).run()
 
+    def run_cli(self):
+        """Hook in before the REPL so we can get the expected output for each question.
+
+        By now, cli() has connected and set up the session (time zone, init-commands)
+        the same way students' queries will see it, and no input has been taken yet.
+        """
+
+        self.quiz.attach_expected(super()._evaluate_command)
+
+        # Pygments is slow, so get the solutions highlighted while they're busy
+        # reading the first question
+        if not self.quiz.closed:
+            threading.Thread(target=self.quiz.prewarm_highlights, daemon=True).start()
+
+        super().run_cli()
+
     def _evaluate_command(self, text):
         """Hook into the PGCli query evaluation so we can check for correct output."""
 
-        # noinspection PyProtectedMember
-        if not self.quiz._expected_attached:
-            # Just once, we have to get the expected output for each question and
-            # put in on the quiz. There isn't a good, post-database-connection hook for
-            # this, so we'll do it here once
-            self.quiz.attach_expected(super()._evaluate_command)
-
         output, query = super()._evaluate_command(text)
 
         if self.quiz.verify_answer(output):
-            message_dialog(title="Success!",
-                           text="You can continue to the next question with \\next").run()
-            with open(self.quiz.filepath + ".log", "a") as out:
-                out.write(f"\n\n*** {self.quiz.current_num}\n\n{text}")
+            if self.quiz.current_num != self._last_verified_num:
+                message_dialog(title="Success!",
+                               text="You can continue to the next question with \\next").run()
+                self._last_verified_num = self.quiz.current_num
+            else:
+                # They've already seen the dialog for this one; don't make them sit
+                # through redrawing it again
+                click.secho("\u2713 correct", fg="green", bold=True)
+            if self._log_fh is None:
+                # Line-buffered, so each answer is on disk without reopening the file
+                self._log_fh = open(self.quiz.filepath + ".log", "a", buffering=1)
+            self._log_fh.write(f"\n\n*** {self.quiz.current_num}\n\n{text}")
 
         return output, query
 
@@ -210,10 +297,7 @@ class QuizCli(pgcli.main.PGCli):
 
     def quiz_show_solution(self, **_):
         """Show answer."""
-        yield None, None, None, highlight(
-            self.quiz.solution(),
-            postgres_lexer,
-            terminal256_formatter)
+        yield None, None, None, self.quiz.highlighted_solution()
 
 
 def main():